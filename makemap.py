@@ -3,29 +3,68 @@ airport,time,dist, f1tail, f1alt, f1lat, f1long, f1track, f2tail, f2alt, f2lat,
 build a dataframe and render it with a folium heatmap
 """
 
+import importlib.util
 import numpy as np
 from folium.plugins import HeatMap
 import folium
 import pandas as pd
 import sys
 
-def get_flight_str(df, index, f2=False):
+HEATMAP_MAX_POINTS = 2000   # above this, render the heatmap to an image
+HEATMAP_BINS = 512
+HEATMAP_SIGMA = 3           # gaussian blur radius, in bins
+
+# columns used from the input CSV, and their types.  Tails repeat a lot so
+# are categorical; altitudes are nullable ints since they may be missing.
+# Tracks are float32, formatted without a trailing ".0" for display.
+CSV_DTYPES = {"airport": "category", "time": "int64", "dist": "float32",
+              "f1tail": "category", "f1alt": "Int32", "f1lat": "float32",
+              "f1lon": "float32", "f1track": "float32",
+              "f2tail": "category", "f2alt": "Int32", "f2track": "float32"}
+
+def get_flight_strs(df, f2=False):
     f_num = "f1" if not f2 else "f2"
-    f_str = f"{df.at[index, f_num + 'tail']}: {df.at[index, f_num + 'alt']} MSL {df.at[index, f_num + 'track']} deg"
-    
-    return f_str
-
-def get_link(df, index):
-    # return link with url of the form https://globe.adsbexchange.com/?replay=2024-06-06-18:32&lat=36.228&lon=-121.123&zoom=10.8
-
-    f1lat = df.at[index, "f1lat"]
-    f1lon = df.at[index, "f1lon"]
-    ts = df.at[index, "time"]
-    # convert ts in epoch seconds to string of the form 2024-06-06-18:32
-    ts_str = pd.to_datetime(ts, unit='s').strftime('%Y-%m-%d-%H:%M')
-    url = f"https://globe.adsbexchange.com/?replay={ts_str}&lat={f1lat}&lon={f1lon}&zoom=14"
-    link = f'<a target="adsx" href="{url}">link</a>'
-    return link
+    f_strs = (df[f_num + "tail"].astype(str) + ": " +
+              df[f_num + "alt"].astype(str) + " MSL " +
+              df[f_num + "track"].map("{:g}".format) + " deg")
+
+    return f_strs
+
+def get_links(df):
+    # return links with urls of the form https://globe.adsbexchange.com/?replay=2024-06-06-18:32&lat=36.228&lon=-121.123&zoom=10.8
+
+    # convert ts in epoch seconds to strings of the form 2024-06-06-18:32
+    ts_strs = pd.to_datetime(df["time"], unit='s').dt.strftime('%Y-%m-%d-%H:%M')
+    urls = ("https://globe.adsbexchange.com/?replay=" + ts_strs +
+            "&lat=" + df["f1lat"].astype(str) +
+            "&lon=" + df["f1lon"].astype(str) + "&zoom=14")
+    links = '<a target="adsx" href="' + urls + '">link</a>'
+    return links
+
+def add_heatmap(m, points_df):
+    """Add a heatmap of the lat/lon points to the map.  Small point sets use
+    the client-side Leaflet.heat layer; larger ones are binned here and
+    added as a single pre-rendered image to keep the browser responsive."""
+    if len(points_df) < HEATMAP_MAX_POINTS:
+        HeatMap(points_df).add_to(m)
+        return
+
+    from matplotlib import colormaps
+    from matplotlib.colors import Normalize
+    from scipy.ndimage import gaussian_filter
+
+    hist, lon_edges, lat_edges = np.histogram2d(
+        points_df["lon"], points_df["lat"], bins=HEATMAP_BINS)
+    hist = gaussian_filter(hist, sigma=HEATMAP_SIGMA)
+    density = Normalize()(hist)
+
+    # histogram is indexed [lon, lat]; transpose so rows run south to north
+    rgba = colormaps["hot"](density.T)
+    rgba[..., 3] = density.T    # fade out empty areas
+    folium.raster_layers.ImageOverlay(
+        image=rgba, origin="lower", opacity=0.6,
+        bounds=[[lat_edges[0], lon_edges[0]],
+                [lat_edges[-1], lon_edges[-1]]]).add_to(m)
 
 def main():
     #     map_airport = ["wvi", 36.9357325, -121.7896375]
@@ -39,63 +78,72 @@ def main():
 
     input_file = sys.argv[1]
 
-    df = pd.read_csv(input_file)
+    engine = "pyarrow" if importlib.util.find_spec("pyarrow") else "c"
+    df = pd.read_csv(input_file, usecols=list(CSV_DTYPES), dtype=CSV_DTYPES,
+                     engine=engine)
     df = df[df["airport"] == map_airport[0]]
     print(df)
     #print(df.T)
-    folium_df = df[["f1lat", "f1lon", "f1alt"]]
-    folium_df.columns = ["lat", "lon", "alt"]
-    print(folium_df)
 
-    # filter out rows where f1alt is < 4000
-    folium_df = folium_df[folium_df["alt"] < 4000]
+    # build all row filters as a single mask over the raw column arrays:
+    # keep rows where f1alt is < 4000, altitude difference between f1alt
+    # and f2alt is <= 400, and distance between f1 and f2 is <= .3 nm
+    f1alt = df["f1alt"].to_numpy(dtype=float, na_value=np.nan)
+    f2alt = df["f2alt"].to_numpy(dtype=float, na_value=np.nan)
+    dist = df["dist"].to_numpy()
+    prox_mask = (f1alt < 4000) & (np.abs(f1alt - f2alt) <= 400) & (dist <= .3)
 
-    # filter out rows where altitude difference between f1alt and f2alt is < 800
-    folium_df = folium_df[abs(df["f1alt"] - df["f2alt"]) <= 400]
+    #print how many rows pass the prox filter
+    print(f"** Number of rows after prox : {np.count_nonzero(prox_mask)}")
+    # filter out rows with N/A position or altitude
+    folium_cols = ["f1lat", "f1lon", "f1alt"]
+    mask = prox_mask & df[folium_cols].notna().all(axis=1).to_numpy()
 
-    # filter out rows where distance between f1 and f2 is < .3 nm
-    folium_df = folium_df[df["dist"] <= .3]
-
-    #print how many rows in folium_df
-    print(f"** Number of rows after prox : {len(folium_df)}")
-    # filter out rows with tail starting with N0000 or N/A
-    folium_df = folium_df.dropna()
+    # only the surviving rows are copied, as plain floats for folium
+    folium_df = df.loc[mask, folium_cols].rename(
+        columns={"f1lat": "lat", "f1lon": "lon", "f1alt": "alt"}).astype(float)
 
     print(f"** Number of rows after n/a filter : {len(folium_df)}")
 
     print(folium_df)
 
     m = folium.Map(location=[map_airport[1], map_airport[2]], zoom_start=14)
-    HeatMap(folium_df).add_to(m)
+    add_heatmap(m, folium_df)
 
     markers_fg = folium.FeatureGroup(name='markers')
 
-    # add points for each row
-    for index, row in folium_df.iterrows():
-        marker = folium.Marker([row["lat"], row["lon"]], radius=300)
-        marker.add_to(markers_fg)
-        # add tooltip with altitude
-        link_str = get_link(df, index)
-        f1str = get_flight_str(df, index)
-        f2str = get_flight_str(df, index, f2=True)
+    # popup text for each marker: link plus both flights
+    popups = (get_links(df) + " " + get_flight_strs(df) + " === " +
+              get_flight_strs(df, f2=True))
+    popups = popups.loc[folium_df.index].to_numpy()
+
+    # track difference between the two flights, for the heading heatmap.
+    # this heading math is not right:
+    abs_track_diffs = (df["f1track"] - df["f2track"]).abs()
+    abs_track_diffs = abs_track_diffs.loc[folium_df.index].to_numpy()
+
+    # add points for each row, collecting points where heading differs by
+    # more than 45 degrees along the way
+    heading_points = []
+    lats = folium_df["lat"].to_numpy()
+    lons = folium_df["lon"].to_numpy()
+    for lat, lon, popup, abs_track_diff in zip(lats, lons, popups,
+                                               abs_track_diffs):
+        marker = folium.Marker([lat, lon], radius=300)
         # make marker clickable to the link
-        marker.add_child(folium.Popup(f"{link_str} {f1str} === {f2str}"))
+        marker.add_child(folium.Popup(popup))
+        marker.add_to(markers_fg)
+        if abs_track_diff > 45:
+            heading_points.append((lat, lon))
 
-#        marker.add_child(folium.Tooltip(f"{link_str} {f1str} === {f2str}"))
+#        marker.add_child(folium.Tooltip(popup))
 #        marker.add_to(m)
 
     markers_fg.add_to(m)
 
     # do another heatmap for only points where heading differs by more than 45 degrees
-    heading_df = pd.DataFrame(
-        None, columns=["lat", "lon"])
-
-    for index, row in folium_df.iterrows():
-        # this heading math is not right:
-        if abs(df.at[index, "f1track"] - df.at[index, "f2track"]) > 45:
-            new_df = pd.DataFrame([[row["lat"], row["lon"]]], columns=["lat", "lon"])
-            heading_df = pd.concat([heading_df, new_df], ignore_index=True)
-    HeatMap(heading_df).add_to(m)
+    heading_df = pd.DataFrame(heading_points, columns=["lat", "lon"])
+    add_heatmap(m, heading_df)
 
     # add layer control
     folium.LayerControl().add_to(m)
@@ -1,12 +1,19 @@
 import argparse
+import asyncio
+import collections
+import heapq
 import signal
 import time
 import sys
 import threading
 import logging
-import json
+import math
+import queue
 import yaml
-import requests
+import httpx
+import orjson
+from tenacity import (retry, retry_if_exception_type, stop_after_attempt,
+                      wait_exponential)
 
 from adsb_actions.adsbactions import AdsbActions
 
@@ -14,56 +21,121 @@ logger = logging.getLogger(__name__)
 logger.level = logging.INFO
 
 LOW_FREQ_DELAY = 60  # 250 kts head-on closure over 60 sec = 4 nm. 40 kts = .6 nm
+MAX_LOW_FREQ_DELAY = 600 # cap on low freq delay after repeated empty queries
+LOW_FREQ_BACKOFF = 1.5 # low freq delay multiplier after an empty query
+RATE_LIMITED_DELAY = 300 # seconds to hold all queries after an HTTP 429
 API_RATE_LIMIT = 1 # seconds between API queries
+API_MAX_IN_FLIGHT = 4 # max API queries in flight at once
+TICK_BUDGET = 1.0   # minimum seconds per monitor loop iteration
 DEACTIVATE_SECS = 30 # no callback in this amount of time = deactivate the airport
 EXPIRE_SECS = 31 # expire aircraft not seen in this many seconds
 INNER_PROX_THRESH = .5
 INNER_PROX_ALT = 500
 OUTFILE = "/tmp/output_events.txt"   # matching events go here
+MAX_QUEUED_EVENTS = 10_000 # events waiting to be written to OUTFILE
+MAX_EVENTS = 100_000    # events kept in memory for dump_events()
 ALL_DATA_OUT = "/tmp/all_data.json"  # place to save all received data, for reproducibility
+MAX_QUERY_RADIUS = 250  # nm, largest radius the API accepts
+EARTH_RADIUS_NM = 3440.065
+
+def write_all(file, data):
+    """Write all of data to an unbuffered binary file, which may accept
+    less than everything in one write."""
+    view = memoryview(data)
+    while view:
+        view = view[file.write(view):]
+
+def latlong_dist_nm(lat1, long1, lat2, long2):
+    """Great circle distance in nm between two points."""
+    lat1, long1, lat2, long2 = map(math.radians, (lat1, long1, lat2, long2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) *
+         math.sin((long2 - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_NM * math.asin(math.sqrt(a))
+
+def rings_overlap(ring1, ring2):
+    """True if two [radius, lat, long] rings overlap."""
+    return (latlong_dist_nm(ring1[1], ring1[2], ring2[1], ring2[2]) <
+            ring1[0] + ring2[0])
+
+def covering_ring(rings):
+    """Return a [radius, lat, long] ring that contains all the given rings."""
+    lats = [ring[1] for ring in rings]
+    longs = [ring[2] for ring in rings]
+    # rounded to ~10 m so query urls stay clean
+    lat = round((min(lats) + max(lats)) / 2, 4)
+    long = round((min(longs) + max(longs)) / 2, 4)
+    radius = max(latlong_dist_nm(lat, long, ring[1], ring[2]) + ring[0]
+                 for ring in rings)
+    return [math.ceil(radius), lat, long]
 
 class AirportState:
-    def __init__(self, name, latlongring, adsb_actions, logfile):
+    """Polling state for one airport.  All timestamps are time.monotonic()."""
+    __slots__ = ('name', 'latlongring', 'query_ring', 'active',
+                 'last_activated', 'next_due', 'backoff', 'adsb_actions')
+
+    def __init__(self, name, latlongring, adsb_actions):
         self.name = name
         self.latlongring = latlongring
+        self.query_ring = latlongring   # may cover neighboring airports too
         self.active = False
-        self.last_checked = 0
         self.last_activated = 0
+        self.next_due = 0       # time of this airport's live due_heap entry
+        self.backoff = LOW_FREQ_DELAY   # current delay between inactive queries
         self.adsb_actions = adsb_actions
-        self.logfile = logfile
 
-    def call_api_and_process(self):
-        logger.debug(f"Doing API query for for {self.name}")
+    async def call_api_and_process(self, client, monitor):
+        """Query the API for this airport's query ring, save the results to
+        the monitor's all_data_file and feed them to adsb_actions.  Queries
+        are rate limited by monitor.api_query().  Returns the number of
+        flights received, or None if the query failed."""
+        radius, lat, long = self.query_ring
 
-        url = f"https://api.airplanes.live/v2/point/{self.latlongring[1]}/{self.latlongring[2]}/{self.latlongring[0]}"
+        logger.debug(f"Doing API query for for {self.name}")
 
-        start_time = time.time()
+        url = f"https://api.airplanes.live/v2/point/{lat}/{long}/{radius}"
 
         # Issue query
         try:
-            response = requests.get(url, timeout=10)
-            json_data = response.json()
+            response = await monitor.api_query(client, url)
+            if response.status_code == 429:
+                return None     # monitor holds off all queries
+            json_data = orjson.loads(response.content)
         except Exception as e:      # pylint: disable=broad-except
             logger.error(f"error in API query: {str(e)}")
-            return
+            return None
 
         logger.info(f"got {len(json_data['ac'])} flights")
 
-        # Process data from API call.
-        # XXX should be optimized to not go to string then back to json:
-        json_list = ""      # list of json objects, a weird format
-        for line in json_data['ac']:
-            line['now'] = json_data['now'] / 1000
-            json_list += json.dumps(line) + "\n"
-
-        self.logfile.write(json_list)
-        self.adsb_actions.loop(string_data=json_list)
-        self.last_checked = done_time = time.time()
-
-        if (done_time - start_time) < API_RATE_LIMIT:
-            time.sleep(API_RATE_LIMIT - (done_time - start_time))
+        # Process data from API call, handing the parsed records straight
+        # to adsb_actions.
+        records = json_data['ac']
+        now_s = json_data['now'] / 1000
+        for record in records:
+            record['now'] = now_s
+
+        if records:
+            write_all(monitor.all_data_file,
+                      b"\n".join(map(orjson.dumps, records)) + b"\n")
+        self.adsb_actions.loop(iterator_data=iter(records))
+        return len(records)
+
+    def update_backoff(self, num_flights):
+        """Back off the low freq checks while the vicinity stays empty."""
+        if num_flights:
+            self.backoff = LOW_FREQ_DELAY
+        else:
+            self.backoff = min(self.backoff * LOW_FREQ_BACKOFF,
+                               MAX_LOW_FREQ_DELAY)
+
+    def poll_interval(self):
+        """Seconds until this airport should be queried again."""
+        if self.active:
+            return API_RATE_LIMIT
+        return self.backoff
 
 class Event:
+    __slots__ = ('f1str', 'f2str', 'f1loc', 'f2loc', 'airport')
+
     def __init__(self, flight1, flight2, airport):
         self.f1str = flight1.to_str()
         self.f2str = flight2.to_str()
@@ -77,36 +149,107 @@ class Event:
                 f"{self.f1str} === {self.f2str}")
 
 class MonitorThread:
-    def __init__(self, adsb_actions):
+    def __init__(self, adsb_actions, all_data_file):
         self.airports = {}
+        self.due_heap = []      # (due time, airport name), guarded by airports_lock
+        # query ring tuple -> airports covered by it, from coalesce_airports()
+        self.ring_members = {}
+        self.next_query_time = 0    # earliest time the next API query may start
+        self.query_start_lock = None  # set by start_rate_limiting()
+        self.in_flight = None
         self.airports_lock = threading.Lock()
         self.monitor_thread = threading.Thread(target=self.monitor_thread_loop)
         self.adsb_actions = adsb_actions
-        self.event_dict = {}
-        self.event_file = open(OUTFILE, "w")
+        self.all_data_file = all_data_file
+        self.events = collections.deque(maxlen=MAX_EVENTS)
+        self.event_file = open(OUTFILE, "w", buffering=1 << 16)
         self.event_file.write("log start at " + str(time.time()) + "\n")
+        # event lines are written by writer_thread, off the detection path.
+        # Started here since --data_file replays never call run().
+        self.event_queue = queue.Queue(maxsize=MAX_QUEUED_EVENTS)
+        self.writer_thread = threading.Thread(target=self.writer_thread_loop,
+                                              daemon=True)
+        self.writer_thread.start()
         self.thread_running = False
 
     def run(self):
+        self.coalesce_airports()
         self.thread_running = True
         self.monitor_thread.start()
 
     def dump_events(self):
-        for event in self.event_dict.values():
+        for event in self.events:
             logger.debug(event.to_str())
 
     def handle_exit(self, *_):
         logger.debug("Dumping all events:")
         self.dump_events()
-        self.event_file.close()
-        list(self.airports.values())[0].logfile.close()
+        self.close_events()
+        self.all_data_file.close()
         sys.exit(0)
 
-    def add_airport(self, name, latlongring, logfile):
+    def writer_thread_loop(self):
+        """Write queued event lines to the event file in batches, until the
+        None sentinel from close_events() is dequeued."""
+        while True:
+            items = [self.event_queue.get()]
+            while not self.event_queue.empty():
+                items.append(self.event_queue.get_nowait())
+            done = None in items
+            self.event_file.write("".join(
+                item for item in items if item is not None))
+            self.event_file.flush()
+            if done:
+                return
+
+    def close_events(self):
+        """Write out any queued events and close the event file."""
+        self.event_queue.put(None)
+        self.writer_thread.join()
+        self.event_file.close()
+
+    def add_airport(self, name, latlongring):
         logger.info(f"Adding {name}")
         with self.airports_lock:
             self.airports[name] = AirportState(name, latlongring,
-                                               self.adsb_actions, logfile)
+                                               self.adsb_actions)
+            self.schedule_airport(self.airports[name], time.monotonic())
+
+    def coalesce_airports(self):
+        """Give airports with overlapping vicinities a single shared query
+        ring covering all of them, so one API query serves the group."""
+        groups = []
+        with self.airports_lock:
+            for airport in self.airports.values():
+                for group in groups:
+                    if not any(rings_overlap(airport.latlongring, a.latlongring)
+                               for a in group):
+                        continue
+                    ring = covering_ring([a.latlongring
+                                          for a in group + [airport]])
+                    if ring[0] <= MAX_QUERY_RADIUS:
+                        group.append(airport)
+                        break
+                else:
+                    groups.append([airport])
+
+            self.ring_members = {}
+            for group in groups:
+                if len(group) == 1:
+                    ring = group[0].latlongring
+                else:
+                    ring = covering_ring([a.latlongring for a in group])
+                    logger.info(f"Sharing queries for {[a.name for a in group]}")
+                for airport in group:
+                    airport.query_ring = ring
+                self.ring_members[tuple(ring)] = group
+
+    def schedule_airport(self, airport, due_time):
+        """Set when the airport is next due for a query.  Any earlier heap
+        entry for it goes stale and is skipped when popped.  Caller must
+        hold airports_lock."""
+        airport.next_due = due_time
+        heapq.heappush(self.due_heap, (due_time, airport.name))
 
     def activate_airport(self, name):
         if not self.thread_running:     # XXX hack
@@ -114,8 +257,13 @@ class MonitorThread:
 
         # print(f"Activating {name}")
         with self.airports_lock:
-            self.airports[name].active = True
-            self.airports[name].last_activated = time.time()
+            now = time.monotonic()
+            airport = self.airports[name]
+            airport.last_activated = now
+            if not airport.active:
+                # query right away rather than at the next low freq check
+                airport.active = True
+                self.schedule_airport(airport, now)
 
     def deactivate_airport(self, name):
         if not self.thread_running:
@@ -126,40 +274,121 @@ class MonitorThread:
             self.airports[name].active = False
 
     def monitor_thread_loop(self):
-        while True:
-            start_loop_time = time.time()
-
-            ret = self.check_all_airports()
-            if ret == 0:        # didn't sleep in check_all_airports()
-                time.sleep(1)
-
-    def check_all_airports(self):
-        """Query vicinity of each airport at a frequency determined according
-        to each one's active state.  Returns number of API queries issued."""
-        query_ctr = 0
-
-        for airport in self.airports.values():
-            if airport.active:
-                if airport.last_activated + DEACTIVATE_SECS < time.time():
-                    self.deactivate_airport(airport.name)
+        asyncio.run(self._run())
+
+    def start_rate_limiting(self):
+        """Create the asyncio primitives api_query() rate limits with.  Must
+        be called on the event loop that will issue the queries."""
+        self.query_start_lock = asyncio.Lock()
+        self.in_flight = asyncio.Semaphore(API_MAX_IN_FLIGHT)
+
+    async def _run(self):
+        self.start_rate_limiting()
+        # one client shared by all airports, for connection reuse and
+        # HTTP/2 multiplexing
+        async with httpx.AsyncClient(http2=True) as client:
+            while True:
+                start_loop_time = time.monotonic()
+                await self.check_all_airports(client)
+
+                # sleep until the next airport is due, but no less than the
+                # rest of the tick budget so the loop can't spin
+                with self.airports_lock:
+                    next_due = (self.due_heap[0][0] if self.due_heap
+                                else start_loop_time + TICK_BUDGET)
+                now = time.monotonic()
+                elapsed = now - start_loop_time
+                await asyncio.sleep(max(0, TICK_BUDGET - elapsed,
+                                        next_due - now))
+
+    async def wait_for_rate_limit(self):
+        """Wait until another API query may start, spacing query starts
+        API_RATE_LIMIT seconds apart.  Also waits out any rate limited
+        hold set while waiting."""
+        async with self.query_start_lock:
+            while (wait_time := self.next_query_time - time.monotonic()) > 0:
+                await asyncio.sleep(wait_time)
+            self.next_query_time = time.monotonic() + API_RATE_LIMIT
+
+    @retry(wait=wait_exponential(max=10), stop=stop_after_attempt(3),
+           retry=retry_if_exception_type(httpx.TransportError), reraise=True)
+    async def api_query(self, client, url):
+        """Issue an API query once the rate limit allows, with at most
+        API_MAX_IN_FLIGHT queries outstanding.  Transient network errors
+        are retried, each attempt waiting on the rate limit again.  An
+        HTTP 429 holds off every query for RATE_LIMITED_DELAY, since the
+        API's limit applies to this whole client."""
+        async with self.in_flight:
+            await self.wait_for_rate_limit()
+            response = await client.get(url, timeout=10)
+        if response.status_code == 429:
+            logger.warning(f"API rate limited, holding all queries for "
+                           f"{RATE_LIMITED_DELAY}s")
+            self.next_query_time = max(self.next_query_time,
+                                       time.monotonic() + RATE_LIMITED_DELAY)
+        return response
+
+    async def check_all_airports(self, client):
+        """Query vicinity of each airport that is due, then reschedule it at
+        a frequency determined according to its active state.  Airports
+        sharing a query ring are queried once and all rescheduled from that
+        query.  Queries are issued concurrently, rate-limited by
+        api_query().  Returns number of API queries issued."""
+        now = time.monotonic()
+        popped = []
+        with self.airports_lock:
+            while self.due_heap and self.due_heap[0][0] <= now:
+                due_time, name = heapq.heappop(self.due_heap)
+                airport = self.airports[name]
+                if due_time == airport.next_due:
+                    popped.append(airport)
+
+        due = []
+        for airport in popped:
+            if airport.active and airport.last_activated + DEACTIVATE_SECS < now:
+                self.deactivate_airport(airport.name)
+                with self.airports_lock:
+                    self.schedule_airport(airport,
+                                          now + airport.poll_interval())
+                continue
+            if not airport.active:
+                logger.debug("low freq check due")
+            due.append(airport)
+
+        # one query per ring, however many of the airports sharing it are due
+        queries = {}
+        for airport in due:
+            queries.setdefault(tuple(airport.query_ring), airport)
+
+        results = dict(zip(queries, await asyncio.gather(
+            *[airport.call_api_and_process(client, self)
+              for airport in queries.values()])))
+
+        done_time = time.monotonic()
+        with self.airports_lock:
+            # a successful query covers every airport sharing its ring, due
+            # or not, so reschedule them all from it
+            for ring, num_flights in results.items():
+                if num_flights is None:
                     continue
-                airport.call_api_and_process()
-                query_ctr += 1
-            else:
-                if time.time() - airport.last_checked > LOW_FREQ_DELAY:
-                    airport.call_api_and_process()
-                    query_ctr += 1
-                    logger.debug("low freq check done")
+                for airport in self.ring_members.get(ring, [queries[ring]]):
+                    airport.update_backoff(num_flights)
+                    self.schedule_airport(airport,
+                                          done_time + airport.poll_interval())
+            for airport in due:
+                if results[tuple(airport.query_ring)] is None:
+                    self.schedule_airport(airport,
+                                          done_time + airport.poll_interval())
+
         logger.debug(
-            f"Done checking all, {len(self.event_dict)} events stored")
-        return query_ctr
+            f"Done checking all, {len(self.events)} events stored")
+        return len(queries)
 
     def prox_callback(self, flight, flight2):
-        try:
-            airport = flight.flags['note']
-        except:
+        airport = flight.flags.get('note')
+        if airport is None:
             logger.error("No airport in flags")
-            raise
+            return
         logger.info(
             f"prox callback activating {airport}: {flight.flight_id} {flight2.flight_id}")
 
@@ -169,8 +398,7 @@ class MonitorThread:
         flight_alt_delta = abs(flight.lastloc.alt_baro - flight2.lastloc.alt_baro)
 
         if flight_dist < INNER_PROX_THRESH and flight_alt_delta < INNER_PROX_ALT:
-            has_logged = flight.flags.get('logged', False)
-            if has_logged:
+            if flight.flags.get('logged'):
                 logger.info(f"*** already logged {airport}: {flight_dist}nm, "
                       f"{flight.to_str()}, {flight2.to_str()}")
                 return
@@ -178,13 +406,16 @@ class MonitorThread:
             logger.info(f"*** below inner thresh range {airport}: {flight_dist}nm, "
                   f"{flight.to_str()}, {flight2.to_str()}")
             event = Event(flight, flight2, airport)
-            self.event_dict[flight.lastloc.now] = event
-            self.event_file.write(f"{event.to_str()}\n")
+            self.events.append(event)
+            try:
+                self.event_queue.put_nowait(f"{event.to_str()}\n")
+            except queue.Full:
+                logger.error("event queue full, dropping event")
 
 def generate_dicts_from_file(file_path):
     with open(file_path, "r") as file:
         for line in file:
-            yield json.loads(line)
+            yield orjson.loads(line)
 
 if __name__ == "__main__":
     logging.basicConfig(
@@ -207,12 +438,12 @@ if __name__ == "__main__":
             sys.exit(-1)
 
     # open logfile for all data
-    all_data_file = open(ALL_DATA_OUT, "w")
+    all_data_file = open(ALL_DATA_OUT, "wb", buffering=0)
 
     # set up processing environment
     adsb_actions = AdsbActions(yaml_data=yaml_data, expire_secs=EXPIRE_SECS,
                                pedantic=True)
-    monitor_thread = MonitorThread(adsb_actions)
+    monitor_thread = MonitorThread(adsb_actions, all_data_file)
 
     signal.signal(signal.SIGINT, monitor_thread.handle_exit)
 
@@ -224,14 +455,14 @@ if __name__ == "__main__":
         # just read in data from file, no threading needed
         iterator = generate_dicts_from_file(args.data_file)
         adsb_actions.loop(iterator_data=iterator)
+        monitor_thread.close_events()
     else:
         # read in airport details to monitor
         try:
             for rulename, rulebody in yaml_data['rules'].items():
                 if rulebody['conditions']['latlongring']:
                     monitor_thread.add_airport(rulename,
-                                            rulebody['conditions']['latlongring'],
-                                            all_data_file)
+                                            rulebody['conditions']['latlongring'])
         except Exception as ex:      # pylint: disable=broad-except
             logger.error("error in yaml file: " + str(ex))
 
@@ -0,0 +1,131 @@
+"""Tests for tcp_client's API polling, run against a mock HTTP transport."""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import tcp_client
+
+
+class StubAdsbActions:
+    def loop(self, **_):
+        pass
+
+
+@pytest.fixture
+def make_monitor(tmp_path, monkeypatch):
+    """Factory for MonitorThreads writing only under tmp_path, with the
+    given airports added and coalesced."""
+    monkeypatch.setattr(tcp_client, "OUTFILE",
+                        str(tmp_path / "output_events.txt"))
+    monitors = []
+
+    def make(airports):
+        all_data_file = open(tmp_path / "all_data.json", "wb", buffering=0)
+        monitor = tcp_client.MonitorThread(StubAdsbActions(), all_data_file)
+        monitors.append(monitor)
+        for name, latlongring in airports.items():
+            monitor.add_airport(name, latlongring)
+        monitor.coalesce_airports()
+        return monitor
+
+    yield make
+    for monitor in monitors:
+        monitor.close_events()
+        monitor.all_data_file.close()
+
+
+def run_pass(monitor, handler):
+    """Run one check_all_airports() pass, answering API queries with
+    handler."""
+    async def check():
+        monitor.start_rate_limiting()
+        transport = httpx.MockTransport(handler)
+        async with httpx.AsyncClient(transport=transport) as client:
+            await monitor.check_all_airports(client)
+    asyncio.run(check())
+
+
+def test_nearby_rings_query_separately(make_monitor):
+    # ~6 nm apart with 3 nm radii: close, but not overlapping
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        return httpx.Response(200, json={"ac": [], "now": 0})
+
+    monitor = make_monitor({"a": [3, 37.01, -121.99],
+                            "b": [3, 37.09, -121.91]})
+    run_pass(monitor, handler)
+
+    assert sorted(paths) == ["/v2/point/37.01/-121.99/3",
+                             "/v2/point/37.09/-121.91/3"]
+
+
+def test_query_starts_are_rate_limited(make_monitor, monkeypatch):
+    monkeypatch.setattr(tcp_client, "API_RATE_LIMIT", .05)
+    start_times = []
+
+    def handler(request):
+        start_times.append(time.monotonic())
+        return httpx.Response(200, json={"ac": [], "now": 0})
+
+    # far apart, so every airport gets its own query
+    monitor = make_monitor({f"a{i}": [3, 30 + i, -120]
+                            for i in range(6)})
+    run_pass(monitor, handler)
+
+    assert len(start_times) == 6
+    gaps = [b - a for a, b in zip(start_times, start_times[1:])]
+    assert min(gaps) >= .05 * .9
+
+
+def test_rate_limited_response_holds_all_queries(make_monitor,
+                                                 monkeypatch):
+    monkeypatch.setattr(tcp_client, "API_RATE_LIMIT", .01)
+    monkeypatch.setattr(tcp_client, "RATE_LIMITED_DELAY", .2)
+    start_times = []
+
+    def handler(request):
+        start_times.append(time.monotonic())
+        if len(start_times) == 1:
+            return httpx.Response(429)
+        return httpx.Response(200, json={"ac": [], "now": 0})
+
+    monitor = make_monitor({"a": [3, 30, -120],
+                            "b": [3, 40, -120]})
+    run_pass(monitor, handler)
+
+    # the 429 for one airport delays the query for the other
+    assert len(start_times) == 2
+    assert start_times[1] - start_times[0] >= .2 * .9
+
+
+def test_overlapping_airports_share_query(make_monitor, monkeypatch):
+    monkeypatch.setattr(tcp_client, "API_RATE_LIMIT", .01)
+    monkeypatch.setattr(tcp_client, "LOW_FREQ_DELAY", .05)
+    monkeypatch.setattr(tcp_client, "MAX_LOW_FREQ_DELAY", .05)
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        return httpx.Response(200, json={"ac": [], "now": 0})
+
+    # ~1.2 nm apart with 3 nm radii: coalesced into one ring
+    monitor = make_monitor({"a": [3, 37.0, -122.0],
+                            "b": [3, 37.02, -122.0]})
+    a, b = monitor.airports["a"], monitor.airports["b"]
+
+    # drift b's schedule away from a's, so only a is due
+    with monitor.airports_lock:
+        monitor.schedule_airport(b, time.monotonic() + .02)
+    run_pass(monitor, handler)
+
+    # a's query covered b, so both were rescheduled from it
+    assert a.next_due == b.next_due
+    time.sleep(.06)
+    run_pass(monitor, handler)
+
+    assert paths == ["/v2/point/37.01/-122.0/4"] * 2